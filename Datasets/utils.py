@@ -29,8 +29,18 @@ def append_to_parquet_table(dataframe, filepath=None, writer=None):
     return writer
 
 
-def read_parquet (filepath):
-    table = pq.read_table(filepath)
+def read_parquet (filepath, columns=None):
+    """Reads a parquet file into a pandas DataFrame.
+
+    :param filepath: parquet file location.
+    :param columns: optional list of columns to read, the others are skipped by pyarrow.
+        Columns missing from the file are ignored.
+    :return: pd.DataFrame
+    """
+    if columns is not None:
+        names = pq.read_schema(filepath).names
+        columns = [column for column in columns if column in names]
+    table = pq.read_table(filepath, columns=columns)
     df = table.to_pandas()
     return df
 
@@ -35,6 +35,11 @@ class KeyModel:
     def __init__(self):
         pass
 
+    def get_keywords_batch(self, texts, n=10):
+        """Returns get_keywords(text, n) for each text. Models that can
+        process several documents at once override this."""
+        return [self.get_keywords(text, n=n) for text in texts]
+
     def normalize_weights(self, weights):
         max_value = max(weights)
         min_val = min(weights)
@@ -149,6 +154,31 @@ class keyBert(KeyModel):
 
         return keyphrases, weights
 
+    def get_keywords_batch(self, texts, n=10):
+        """Extracts keywords for all texts with one KeyBERT call, so the
+        documents are embedded together instead of one at a time."""
+        try:
+            batch_keywords = self.model.extract_keywords(
+                texts, keyphrase_ngram_range=(1, 3), top_n=n
+            )
+        except:
+            return super().get_keywords_batch(texts, n=n)
+
+        batch = []
+        for keywords in batch_keywords:
+            # keybert marks documents without candidates with ["None Found"]
+            # instead of a list of (keyword, score) pairs
+            if keywords and all(
+                isinstance(k, (tuple, list)) and len(k) == 2 for k in keywords
+            ):
+                # the multi-document path returns the top n in ascending
+                # similarity, get_keywords returns them best first
+                batch.append(list(map(list, zip(*keywords[::-1]))))
+            else:
+                logging.warning("model was not able to retrieve keywords")
+                batch.append((None, None))
+        return batch
+
 
 class Textacy(KeyModel):
     def __init__(self, model_name):
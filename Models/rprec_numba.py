@@ -0,0 +1,112 @@
+import numpy as np
+from numba import njit
+
+
+def encode_phrases(phrases, vocab):
+    """Encodes phrases as one flat array of token ids plus phrase offsets.
+
+    Tokens of phrase i are ids[offsets[i]:offsets[i + 1]]. vocab maps tokens
+    to ids and is extended in place, so phrases encoded with the same vocab
+    share ids.
+    """
+    ids = []
+    offsets = [0]
+    for phrase in phrases:
+        for token in phrase.split():
+            if token not in vocab:
+                vocab[token] = len(vocab)
+            ids.append(vocab[token])
+        offsets.append(len(ids))
+    return np.array(ids, dtype=np.int32), np.array(offsets, dtype=np.int32)
+
+
+def encode_keywords(keywords, phrase_vocab, token_vocab):
+    """Encodes keywords for score_doc: one id per whole keyword, plus the
+    token ids and offsets from encode_phrases."""
+    phrase_ids = []
+    for keyword in keywords:
+        if keyword not in phrase_vocab:
+            phrase_vocab[keyword] = len(phrase_vocab)
+        phrase_ids.append(phrase_vocab[keyword])
+    ids, offsets = encode_phrases(keywords, token_vocab)
+    return np.array(phrase_ids, dtype=np.int32), ids, offsets
+
+
+@njit(cache=True, fastmath=True)
+def _rprec_pair(gold_ids, g_start, g_end, pred_ids, p_start, p_end):
+    """Relaxed precision of one predicted phrase against one gold phrase:
+    predicted tokens found in the gold phrase, divided by the longer of the
+    two phrase lengths.
+
+    Phrases are short, so a linear scan over the gold tokens is used instead
+    of a hash lookup.
+    """
+    length = max(g_end - g_start, p_end - p_start)
+    if length == 0:
+        return 0.0
+    occur_count = 0
+    for k in range(p_start, p_end):
+        for m in range(g_start, g_end):
+            if pred_ids[k] == gold_ids[m]:
+                occur_count += 1
+                break
+    return occur_count / length
+
+
+@njit(cache=True, fastmath=True)
+def rprec_matrix(gold_ids, gold_off, pred_ids, pred_off, out):
+    """Fills out[i, j] with the relaxed precision of predicted phrase j
+    against gold phrase i."""
+    for i in range(len(gold_off) - 1):
+        for j in range(len(pred_off) - 1):
+            out[i, j] = _rprec_pair(
+                gold_ids,
+                gold_off[i],
+                gold_off[i + 1],
+                pred_ids,
+                pred_off[j],
+                pred_off[j + 1],
+            )
+
+
+@njit(cache=True)
+def score_doc(gold_phrases, gold_ids, gold_off, pred_phrases, pred_ids, pred_off):
+    """Returns (f1, recall, precision, Rprecision) of one document from
+    keywords encoded with encode_keywords (sharing both vocabs).
+
+    A predicted keyword matches when its phrase id is among the gold phrase
+    ids. Empty gold or predicted keywords score 0.0.
+    """
+    n_gold = len(gold_phrases)
+    n_pred = len(pred_phrases)
+    if n_gold == 0 or n_pred == 0:
+        return 0.0, 0.0, 0.0, 0.0
+
+    occur_count = 0
+    for j in range(n_pred):
+        for i in range(n_gold):
+            if pred_phrases[j] == gold_phrases[i]:
+                occur_count += 1
+                break
+    recall = occur_count / n_gold
+    precision = occur_count / n_pred
+    f1 = 0.0
+    if recall + precision > 0:
+        f1 = (2.0 * precision * recall) / (precision + recall)
+
+    total = 0.0
+    for i in range(n_gold):
+        best = 0.0
+        for j in range(n_pred):
+            score = _rprec_pair(
+                gold_ids,
+                gold_off[i],
+                gold_off[i + 1],
+                pred_ids,
+                pred_off[j],
+                pred_off[j + 1],
+            )
+            if score > best:
+                best = score
+        total += best
+    return f1, recall, precision, total / n_gold
@@ -0,0 +1,19 @@
+import pytest
+
+models = pytest.importorskip("Models.models")
+
+
+def test_get_keywords_batch_conversion():
+    model = models.keyBert.__new__(models.keyBert)
+
+    class StubKeyBERT:
+        def extract_keywords(self, docs, keyphrase_ngram_range, top_n):
+            # keybert 0.2.0 multi-document output: ascending similarity, and
+            # ["None Found"] for a document without candidates
+            return [[("svm", 0.2), ("deep learning", 0.9)], ["None Found"]]
+
+    model.model = StubKeyBERT()
+    batch = model.get_keywords_batch(["text one", "text two"], n=2)
+
+    assert batch[0] == [["deep learning", "svm"], [0.9, 0.2]]
+    assert batch[1] == (None, None)
@@ -1,42 +1,28 @@
 import csv
+import functools
 import json
 import random
+import sys
 import time
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, TextIO, Tuple
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from tqdm import tqdm
 
-from Datasets.utils import clean, read_parquet
+from Datasets.utils import read_parquet
 from Models.models import BibRank, KeyModel
 from Models.bibrank import get_weights
+from Models.rprec_numba import encode_keywords, encode_phrases, rprec_matrix, score_doc
 
+# characters used for the random labels of logged evaluation runs
+_ALPHABET = "1234567890qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM"
 
-def mask(text1: str, text2: str) -> List[str]:
-    """Vectorizes two strings into lists of integers.
-
-    Args:
-    text1: A string to be vectorized.
-    text2: A string to be vectorized.
-
-    Returns:
-    A tuple of two lists of integers, representing the vectorized versions of text1 and text2.
-    """
-    base = 0
-    vectors = {}
-    vector1, vector2 = [], []
-    for phrase in text1:
-        if phrase not in vectors:
-            vectors[phrase] = base
-            base += 1
-        vector1.append(vectors[phrase])
-
-    for phrase in text2:
-        if phrase not in vectors:
-            vectors[phrase] = base
-            base += 1
-        vector2.append(vectors[phrase])
-    return vector1, vector2
+# the only dataset columns get_key_abs filters on or returns
+_KEY_ABS_COLUMNS = ["abstract", "bib_file", "bibsource", "journal", "keywords", "year"]
 
 
 def get_recall(l1: List[str], l2: List[str]) -> float:
@@ -51,21 +37,17 @@ def get_recall(l1: List[str], l2: List[str]) -> float:
     Returns:
     A float representing the recall of l1 and l2.
     """
-    occur_count = 0.0
-
-    for each in l2:
-        if each in l1:
-            occur_count += 1.0
-    return occur_count / float(len(l1))
+    if not l1:
+        return 0.0
+    s1 = frozenset(l1)
+    return sum(1 for each in l2 if each in s1) / float(len(l1))
 
 
 def get_precision(l1: List[str], l2: List[str]) -> float:
-    occur_count = 0.0
-
-    for each in l2:
-        if each in l1:
-            occur_count += 1.0
-    return occur_count / float(len(l2))
+    if not l2:
+        return 0.0
+    s1 = frozenset(l1)
+    return sum(1 for each in l2 if each in s1) / float(len(l2))
 
 
 def get_f1(r: float, p: float) -> float:
@@ -74,36 +56,51 @@ def get_f1(r: float, p: float) -> float:
     return (2.0 * p * r) / (p + r)
 
 
-def get_Rprecision(phrase1: List[str], phrase2: List[str]) -> float:
-    """relaxed since it uses "in" instead of checking the position of words."""
-    occur_count = 0.0
+def get_Rprecision(phrase1: str, phrase2: str) -> float:
+    """relaxed since it uses "in" instead of checking the position of words.
 
-    for w1 in phrase2.split():
-        if w1 in phrase1:
-            occur_count += 1
-
-    return occur_count / max(len(phrase2.split()), len(phrase1.split()))
+    Words of phrase2 are matched against the words of phrase1, not against
+    substrings of it ("net" does not match "network").
+    """
+    words1 = phrase1.split()
+    words2 = phrase2.split()
+    tokens1 = set(words1)
+    occur_count = sum(1 for w in words2 if w in tokens1)
+    length = max(len(words1), len(words2))
+    return occur_count / length if length else 0.0
 
 
 def get_all_Rprecision(
     gold_keywords: List[str], predicted_keywords: List[str]
 ) -> float:
-    scores = []
-    for gphrase in gold_keywords:
-        rscores = []
-        for pphrase in predicted_keywords:
-            rscores.append(get_Rprecision(gphrase, pphrase))
-        scores.append(max(rscores))
+    """Mean over gold phrases of the best get_Rprecision against any prediction."""
+    if not gold_keywords or not predicted_keywords:
+        return 0.0
+
+    vocab = {}
+    gold_ids, gold_off = encode_phrases(gold_keywords, vocab)
+    pred_ids, pred_off = encode_phrases(predicted_keywords, vocab)
+    scores = np.empty((len(gold_keywords), len(predicted_keywords)))
+    rprec_matrix(gold_ids, gold_off, pred_ids, pred_off, scores)
+
+    return float(scores.max(axis=1).mean())
 
-    return sum(scores) / len(scores)
+
+def _score_encoded(
+    gold_keywords: List[str],
+    encoded_predicted: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    phrase_vocab: Dict[str, int],
+    token_vocab: Dict[str, int],
+) -> List[float]:
+    """get_scores for predicted keywords already encoded with encode_keywords."""
+    encoded_gold = encode_keywords(gold_keywords, phrase_vocab, token_vocab)
+    return score_doc(*encoded_gold, *encoded_predicted)
 
 
 def get_scores(gold_keywords: List[str], predicted_keywords: List[str]) -> List[float]:
-    recall = get_recall(gold_keywords, predicted_keywords)
-    precision = get_precision(gold_keywords, predicted_keywords)
-    f1 = get_f1(recall, precision)
-    Rprecision = get_all_Rprecision(gold_keywords, predicted_keywords)
-    return f1, recall, precision, Rprecision
+    phrase_vocab, token_vocab = {}, {}
+    encoded_predicted = encode_keywords(predicted_keywords, phrase_vocab, token_vocab)
+    return _score_encoded(gold_keywords, encoded_predicted, phrase_vocab, token_vocab)
 
 
 def get_all_scores(
@@ -113,24 +110,90 @@ def get_all_scores(
     adjust: bool = False,
 ) -> List:
     """SemEval-2010 Task 5, micro averaged f1, recall, precision."""
-    metrics = get_scores(gold_keywords, predicted_keywords)
+    phrase_vocab, token_vocab = {}, {}
+    encoded_predicted = encode_keywords(predicted_keywords, phrase_vocab, token_vocab)
+    metrics = _score_encoded(
+        gold_keywords, encoded_predicted, phrase_vocab, token_vocab
+    )
 
-    adjusted_gold = []
     adjusted_metrics = []
     if adjust:
         if text:
-            for each in gold_keywords:
-                if each in text:
-                    adjusted_gold.append(each)
-            if len(adjusted_gold) < 1:
-                adjusted_metrics = []
-            else:
-                adjusted_metrics = get_scores(adjusted_gold, predicted_keywords)
+            adjusted_gold = [each for each in gold_keywords if each in text]
+            if adjusted_gold:
+                adjusted_metrics = _score_encoded(
+                    adjusted_gold, encoded_predicted, phrase_vocab, token_vocab
+                )
 
     return metrics, adjusted_metrics
 
 
-def get_key_abs(
+@functools.lru_cache(maxsize=4)
+def _cached_read_parquet(filepath: str) -> pd.DataFrame:
+    """read_parquet shared between get_key_abs calls on the same file, e.g. the
+    evaluation and the bib_weights datasets in eval_file. Callers must not
+    modify the returned frame in place."""
+    return read_parquet(filepath, columns=_KEY_ABS_COLUMNS)
+
+
+@functools.lru_cache(maxsize=1)
+def _bib_tables() -> Dict[str, List[str]]:
+    """Maps each bib type in Datasets/bib_info.json to its bib file names."""
+    with open("Datasets/bib_info.json", "rb") as f:
+        tables, _ = json.loads(f.read())
+    new_tables = {}
+    for table in tables:
+        new_tables[table] = []
+        for entry in tables[table]:
+            new_tables[table].append(list(entry.keys())[0])
+    return new_tables
+
+
+def _split_on(keywords: pa.Array, delimiter: str) -> pa.Array:
+    """Splits every string on delimiter and on "---"."""
+    return pc.split_pattern(pc.replace_substring(keywords, "---", delimiter), delimiter)
+
+
+def _split_keywords(keywords: pd.Series) -> List[List[str]]:
+    """Splits each raw keywords string into a list of cleaned keywords.
+
+    A row is split on ";" if it contains one, else on ",", else on "\\t",
+    else on " to", and every part is then split again on "---". Parts are
+    normalised the same way as Datasets.utils.clean. Splitting, stripping and
+    space collapsing run in pyarrow compute kernels; only the final str.lower
+    runs per keyword in Python.
+    """
+    keywords = pa.array(keywords.fillna(""), type=pa.string())
+
+    # "---" shares no characters with any delimiter, so turning it into the
+    # row's delimiter and splitting once gives the same parts as splitting
+    # on the delimiter and then on "---".
+    # Applied lowest priority first, so ";" wins over "," and "," over "\t".
+    parts = _split_on(keywords, " to")
+    for delimiter in ("\t", ",", ";"):
+        parts = pc.if_else(
+            pc.match_substring(keywords, delimiter),
+            _split_on(keywords, delimiter),
+            parts,
+        )
+    rows = pc.list_parent_indices(parts)
+    parts = pc.list_flatten(parts)
+
+    parts = pc.utf8_trim_whitespace(parts)
+    parts = pc.replace_substring(parts, "\n", " ")
+    # only runs of two or more spaces need replacing, which is the same result
+    # as clean's " +" but skips rewriting every single space
+    parts = pc.replace_substring_regex(parts, "  +", " ")
+
+    # lowercased with str.lower like clean (pc.utf8_lower differs on e.g. "İ"
+    # and final "Σ"); gold keywords repeat a lot across documents ("machine
+    # learning"), so interning shares one string object per distinct keyword
+    values = [sys.intern(value.lower()) for value in parts.to_pylist()]
+    offsets = np.searchsorted(rows.to_numpy(), np.arange(len(keywords) + 1)).tolist()
+    return [values[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+def load_dataset(
     filepath: str,
     year1: int = 1900,
     year2: int = 2020,
@@ -157,15 +220,7 @@ def get_key_abs(
         List[str], List[str]: list of keywords and list of abstracts
     """
 
-    jfile = open("Datasets/bib_info.json").read()
-    tables, _ = json.loads(jfile)
-    new_tables = {}
-    for table in tables:
-        new_tables[table] = []
-        for f in tables[table]:
-            new_tables[table].append(list(f.keys())[0])
-
-    df = read_parquet(filepath)
+    df = _cached_read_parquet(filepath)
 
     if bib_files:
         try:
@@ -174,6 +229,7 @@ def get_key_abs(
             df = df[df["bibsource"].isin(bib_files)]
 
     if types:
+        new_tables = _bib_tables()
         types_list = []
         for type in types:
             types_list.extend(new_tables[type])
@@ -182,11 +238,10 @@ def get_key_abs(
     if journals:
         df = df[df["journal"].isin(journals)]
 
-    # year
+    # year, filtered without assigning into df since it may be the cached frame
     try:
-        df["year"] = df["year"].astype("int")
-        df = df[df["year"] >= year1]
-        df = df[df["year"] <= year2]
+        year = df["year"].astype("int")
+        df = df[(year >= year1) & (year <= year2)]
     except Exception:
         pass
 
@@ -195,30 +250,192 @@ def get_key_abs(
     else:
         df = df[:count]
 
-    keywords = df["keywords"].tolist()
+    processed_keywords = _split_keywords(df["keywords"])
     abstracts = df["abstract"].tolist()
 
-    processed_keywords = []
-    for i in range(len(keywords)):
-        if ";" in keywords[i]:
-            keyword = keywords[i].split(";")
-        elif "," in keywords[i]:
-            keyword = keywords[i].split(",")
-        elif "\t" in keywords[i]:
-            keyword = keywords[i].split("\t")
-        else:
-            keyword = keywords[i].split(" to")
+    return processed_keywords, abstracts
 
-        new = []
-        for key in keyword:
-            if "---" in key:
-                key = key.split("---")
-                new.extend([clean(k) for k in key])
-            else:
-                new.append(clean(key))
-        processed_keywords.append(new)
 
-    return processed_keywords, abstracts
+# original name of load_dataset, still used by the notebooks
+get_key_abs = load_dataset
+
+
+def _data_row(
+    abstract: str, gold_keywords: List[str], predicted_keywords: List[str], scores
+) -> List:
+    """Builds one row of the per-model tsv file: the abstract, the gold and
+    predicted keywords joined with ";", then the scores and adjusted scores."""
+    return [
+        abstract,
+        ";".join(gold_keywords),
+        ";".join(predicted_keywords or []),
+        *scores[0],
+        *scores[1],
+    ]
+
+
+def _map(function, items, n_jobs: int = 1):
+    """Like map, but runs function in n_jobs threads when n_jobs > 1.
+    Results are still yielded in the order of items."""
+    if n_jobs <= 1:
+        yield from map(function, items)
+        return
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        yield from executor.map(function, items)
+
+
+def eval_model(
+    keywords_gold: List[List[str]],
+    abstracts: List[str],
+    model: KeyModel,
+    log: bool = True,
+    model_param: str = "",
+    outputpaths: List[str] = ["output.json", "output.tsv"],
+    top_n: int = 10,
+    batch_size: int = 32,
+    n_jobs: int = 1,
+    dataset_info: Dict[str, Any] = {},
+    summary_file: Optional[TextIO] = None,
+    start_time: Optional[float] = None,
+) -> Tuple[List[float], List[float]]:
+    """Evaluates a KeyModel object on documents already returned by load_dataset.
+
+    Loading once and calling eval_model for each model avoids reading and
+    filtering the dataset again for every model.
+
+    Args:
+        keywords_gold: list, the gold keywords of each document.
+        abstracts: list, the abstract of each document.
+        model: KeyModel, the model to be evaluated.
+        log: bool, optional, if True, enables logging.
+        model_param: str, optional, additional parameters to specify for the model.
+        outputpaths: list, optional, a list of file paths to write the evaluation results to.
+        top_n: int, optional, the number of predicted keywords to consider when evaluating the model.
+        batch_size: int, optional, the number of abstracts passed to the model's get_keywords_batch at once.
+        n_jobs: int, optional, the number of batches extracted and scored concurrently in threads. Only use more than 1 with thread-safe models. The logged model_time and scoring_time are sums of per-batch times, so with n_jobs > 1 they can exceed the wall-clock time.
+        dataset_info: dict, optional, how the documents were selected (file_path, year1, ...), added to the logged output.
+        summary_file: file, optional, an open text file (opened with newline="") to append the summary row to instead of outputpaths[1].
+        start_time: float, optional, time.time() at which the logged "time" starts, e.g. before the dataset was loaded. Defaults to the start of eval_model.
+
+    Returns:
+        tuple, the mean F1, recall, precision, Rprecision scores and the same scores adjusted to the keywords that appear in the text.
+    """
+
+    # compile (or load from the numba cache) the scoring kernels before the
+    # per-batch model and scoring timers start
+    get_scores(["warm up"], ["warm up"])
+
+    t1 = time.time() if start_time is None else start_time
+
+    n_docs = len(keywords_gold)
+    all_scores = np.zeros((n_docs, 4))
+    all_scores_adjust = np.zeros((n_docs, 4))
+    adjusted = np.zeros(n_docs, dtype=bool)
+    # time spent in the model and in scoring, in nanoseconds, summed over
+    # batches (so over all threads when n_jobs > 1)
+    T0 = 0
+    T1 = 0
+
+    def score_batch(start):
+        end = start + batch_size
+
+        t3 = time.perf_counter_ns()
+
+        batch_predictions = model.get_keywords_batch(abstracts[start:end], n=top_n)
+
+        t4 = time.perf_counter_ns()
+        batch_scores = []
+        for i, predicted_keywords in zip(range(start, end), batch_predictions):
+            # models return (None, None) when they could not extract keywords;
+            # interned like the gold keywords so equal keywords are usually
+            # the same object when they are compared
+            predicted = [sys.intern(str(k)) for k in predicted_keywords[0] or []]
+            scores = get_all_scores(
+                keywords_gold[i], predicted, abstracts[i], adjust=True
+            )
+            batch_scores.append(scores)
+
+        t5 = time.perf_counter_ns()
+        return batch_predictions, batch_scores, t4 - t3, t5 - t4
+
+    with open(
+        model.model_name.lower() + ".tsv", "w", newline="", buffering=1 << 20
+    ) as data_file_:
+        data_writer = csv.writer(data_file_, delimiter="\t")
+        progress = tqdm(total=len(keywords_gold), mininterval=1.0)
+        starts = range(0, len(keywords_gold), batch_size)
+        for start, (batch_predictions, batch_scores, t_model, t_score) in zip(
+            starts, _map(score_batch, starts, n_jobs)
+        ):
+            for i, predicted_keywords, scores in zip(
+                range(start, start + batch_size), batch_predictions, batch_scores
+            ):
+                data_writer.writerow(
+                    _data_row(
+                        abstracts[i], keywords_gold[i], predicted_keywords[0], scores
+                    )
+                )
+
+                all_scores[i] = scores[0]
+                if scores[1]:
+                    all_scores_adjust[i] = scores[1]
+                    adjusted[i] = True
+
+            T0 += t_model
+            T1 += t_score
+            progress.update(len(batch_predictions))
+        progress.close()
+
+        counts = [n_docs, int(adjusted.sum())]
+
+        all_scores = all_scores.mean(axis=0).tolist() if n_docs else []
+        all_scores_adjust = (
+            all_scores_adjust[adjusted].mean(axis=0).tolist() if counts[1] else []
+        )
+        data_writer.writerow([*all_scores, *all_scores_adjust])
+
+    t = time.time() - t1
+    label = "".join(random.choices(_ALPHABET, k=8))
+
+    output = {
+        "label": label,
+        **dataset_info,
+        "model_name": model.model_name,
+        "model_param": model_param,
+        "counts": counts,
+        "scores": all_scores,
+        "scores_adjusted": all_scores_adjust,
+        "time": t,
+        "model_time": T0 / 1e9,
+        "scoring_time": T1 / 1e9,
+    }
+    if log:
+        with open(outputpaths[0], "a") as json_file:
+            json.dump(output, json_file)
+            json_file.write("\n")
+
+        summary_row = [
+            label,
+            model.model_name,
+            dataset_info.get("file_path", ""),
+            str(counts[0]),
+            str(counts[1]),
+            str(all_scores[0]),
+            str(all_scores[1]),
+            str(all_scores[2]),
+            str(all_scores[3]),
+            str(all_scores_adjust[0]),
+            str(all_scores_adjust[1]),
+            str(all_scores_adjust[2]),
+            str(all_scores_adjust[3]),
+        ]
+        if summary_file is None:
+            with open(outputpaths[1], "a", newline="") as out_file:
+                csv.writer(out_file, delimiter="\t").writerow(summary_row)
+        else:
+            csv.writer(summary_file, delimiter="\t").writerow(summary_row)
+
+    return all_scores, all_scores_adjust
 
 
 def eval_file(
@@ -236,9 +453,13 @@ def eval_file(
     outputpaths: List[str] = ["output.json", "output.tsv"],
     bib_weights: Dict[str, Any] = {},
     top_n: int = 10,
+    batch_size: int = 32,
+    n_jobs: int = 1,
+    summary_file: Optional[TextIO] = None,
 ) -> Dict[str, Any]:
     """Evaluates the performance of a KeyModel object on a dataset specified by
-    filepath.
+    filepath. The documents are selected with load_dataset and scored with
+    eval_model.
 
     Args:
         filepath: str, the path to the file containing the dataset to evaluate.
@@ -255,6 +476,9 @@ def eval_file(
         outputpaths: list, optional, a list of file paths to write the evaluation results to.
         bib_weights: dict, optional, a dictionary of parameters specifying a dataset to use for generating weights for the BibRank model.
         top_n: int, optional, the number of predicted keywords to consider when evaluating the model.
+        batch_size: int, optional, the number of abstracts passed to the model's get_keywords_batch at once.
+        n_jobs: int, optional, the number of batches extracted and scored concurrently in threads. Only use more than 1 with thread-safe models. The logged model_time and scoring_time are sums of per-batch times, so with n_jobs > 1 they can exceed the wall-clock time.
+        summary_file: file, optional, an open text file (opened with newline="") to append the summary row to instead of outputpaths[1].
 
     Returns:
         dict, a dictionary containing information about the evaluation, such as the label, model name, and various evaluation scores.
@@ -262,12 +486,12 @@ def eval_file(
 
     t1 = time.time()
 
-    keywords_gold, abstracts = get_key_abs(
+    keywords_gold, abstracts = load_dataset(
         filepath, year1, year2, bib_files, types, journals, limit, rand
     )
 
     if bib_weights:
-        keywords_gold_w, t = get_key_abs(
+        keywords_gold_w, t = load_dataset(
             filepath=bib_weights["dataset"],
             year1=bib_weights["year1"],
             year2=bib_weights["year2"],
@@ -278,61 +502,7 @@ def eval_file(
 
         model = BibRank(weights)
 
-    all_scores = []
-    all_scores_adjust = []
-    T0 = 0.0
-    T1 = 0.0
-    data_file_ = open(model.model_name.lower() + ".tsv", "w")
-    for i in tqdm(range(len(keywords_gold))):
-
-        t3 = time.time()
-
-        predicted_keywords = model.get_keywords(abstracts[i], n=top_n)
-
-        t4 = time.time()
-        try:
-            scores = get_all_scores(
-                keywords_gold[i], predicted_keywords[0], abstracts[i], adjust=True
-            )
-
-        except Exception:
-            scores = [[0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0]]
-
-        data_line = [abstracts[i], keywords_gold[i], predicted_keywords[0]]
-        data_line.extend(scores)
-        data_line = [str(i) for i in data_line]
-        data_line = "\t".join(data_line)
-        data_file_.write(data_line)
-        data_file_.write("\n")
-
-        t5 = time.time()
-        all_scores.append(scores[0])
-        if scores[1]:
-            all_scores_adjust.append(scores[1])
-        T0 += t4 - t3
-        T1 += t5 - t4
-    all_scores = pd.DataFrame(all_scores)
-    all_scores_adjust = pd.DataFrame(all_scores_adjust)
-
-    counts = [len(all_scores), len(all_scores_adjust)]
-
-    all_scores = list(all_scores.mean(axis=0))
-    all_scores_adjust = list(all_scores_adjust.mean(axis=0))
-    data_line = list(all_scores)
-    data_line.extend(all_scores_adjust)
-    data_line = [str(i) for i in data_line]
-    data_line = "\t".join(data_line)
-    data_file_.write(data_line)
-    data_file_.write("\n")
-
-    t = time.time() - t1
-    label = "".join(
-        random.choice("1234567890qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM")
-        for x in range(8)
-    )
-
-    output = {
-        "label": label,
+    dataset_info = {
         "file_path": filepath,
         "year1": year1,
         "year2": year2,
@@ -340,37 +510,19 @@ def eval_file(
         "types": types,
         "journals": journals,
         "limit": limit,
-        "model_name": model.model_name,
-        "model_param": model_param,
-        "counts": counts,
-        "scores": all_scores,
-        "scores_adjusted": all_scores_adjust,
-        "time": t,
         "random": rand,
     }
-    if log:
-        f1 = open(outputpaths[0], "a")
-        json.dump(output, f1)
-        f1.write("\n")
-
-        with open(outputpaths[1], "a", newline="") as out_file:
-            tsv_writer = csv.writer(out_file, delimiter="\t")
-            tsv_writer.writerow(
-                [
-                    label,
-                    model.model_name,
-                    filepath,
-                    str(counts[0]),
-                    str(counts[1]),
-                    str(all_scores[0]),
-                    str(all_scores[1]),
-                    str(all_scores[2]),
-                    str(all_scores[3]),
-                    str(all_scores_adjust[0]),
-                    str(all_scores_adjust[1]),
-                    str(all_scores_adjust[2]),
-                    str(all_scores_adjust[3]),
-                ]
-            )
-
-    return all_scores, all_scores_adjust
+    return eval_model(
+        keywords_gold,
+        abstracts,
+        model,
+        log=log,
+        model_param=model_param,
+        outputpaths=outputpaths,
+        top_n=top_n,
+        batch_size=batch_size,
+        n_jobs=n_jobs,
+        dataset_info=dataset_info,
+        summary_file=summary_file,
+        start_time=t1,
+    )